@@ -2,16 +2,30 @@
 # MIT License
 """Loading script for DiffusionDB."""
 
-import re
+import os
+import queue
+import shutil
+import zipfile
+import threading
 import numpy as np
-import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 from json import load, dump
-from os.path import join, basename
+from os.path import join, exists
+from hashlib import sha256
+from concurrent.futures import Future, ThreadPoolExecutor
 from huggingface_hub import hf_hub_url
 
 import datasets
 
+# orjson parses the part json files much faster, but it is optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # Find for instance the citation on arxiv or on the dataset repo/website
 _CITATION = """\
 @article{wangDiffusionDBLargescalePrompt2022,
@@ -40,42 +54,57 @@ _VERSION = datasets.Version("0.9.1")
 # Programmatically generate the URLs for different parts
 # hf_hub_url() provides a more flexible way to resolve the file URLs
 # https://huggingface.co/datasets/poloclub/diffusiondb/resolve/main/images/part-000001.zip
-_URLS = {}
-_URLS_LARGE = {}
+# We only resolve the URL once and fill in the filenames when a file is needed,
+# as calling hf_hub_url() for all parts is slow
 _PART_IDS = range(1, 2001)
 _PART_IDS_LARGE = range(1, 14001)
 
-for i in _PART_IDS:
-    _URLS[i] = hf_hub_url(
-        "poloclub/diffusiondb",
-        filename=f"images/part-{i:06}.zip",
-        repo_type="dataset",
-    )
+_URL_FILENAME_PLACEHOLDER = "__FILENAME__"
+_URL_TEMPLATE = hf_hub_url(
+    "poloclub/diffusiondb",
+    filename=_URL_FILENAME_PLACEHOLDER,
+    repo_type="dataset",
+)
 
-for i in _PART_IDS_LARGE:
-    if i < 10001:
-        _URLS_LARGE[i] = hf_hub_url(
-            "poloclub/diffusiondb",
-            filename=f"diffusiondb-large-part-1/part-{i:06}.zip",
-            repo_type="dataset",
-        )
+
+def _part_url(part_id, is_large):
+    """
+    Get the URL of an image part zip file. URLs are only built for the parts
+    that are actually downloaded.
+    Args:
+        part_id (int): The id of the image part
+        is_large (bool): If the part is from DiffusionDB Large
+    Returns:
+        str: URL of the part-xxxxxx.zip file
+    """
+    part_id = int(part_id)
+
+    if not is_large:
+        if part_id not in _PART_IDS:
+            raise ValueError(f"Invalid DiffusionDB 2M part_id: {part_id}")
+        filename = f"images/part-{part_id:06}.zip"
     else:
-        _URLS_LARGE[i] = hf_hub_url(
-            "poloclub/diffusiondb",
-            filename=f"diffusiondb-large-part-2/part-{i:06}.zip",
-            repo_type="dataset",
-        )
+        if part_id not in _PART_IDS_LARGE:
+            raise ValueError(f"Invalid DiffusionDB Large part_id: {part_id}")
+        if part_id < 10001:
+            filename = f"diffusiondb-large-part-1/part-{part_id:06}.zip"
+        else:
+            filename = f"diffusiondb-large-part-2/part-{part_id:06}.zip"
 
-# Add the metadata parquet URL as well
-_URLS["metadata"] = hf_hub_url(
-    "poloclub/diffusiondb", filename="metadata.parquet", repo_type="dataset"
-)
+    return _URL_TEMPLATE.replace(_URL_FILENAME_PLACEHOLDER, filename)
+
+
+def _metadata_url(is_large):
+    """
+    Get the URL of the metadata parquet file.
+    Args:
+        is_large (bool): If getting the metadata of DiffusionDB Large
+    Returns:
+        str: URL of the metadata parquet file
+    """
+    filename = "metadata-large.parquet" if is_large else "metadata.parquet"
+    return _URL_TEMPLATE.replace(_URL_FILENAME_PLACEHOLDER, filename)
 
-_URLS_LARGE["metadata"] = hf_hub_url(
-    "poloclub/diffusiondb",
-    filename="metadata-large.parquet",
-    repo_type="dataset",
-)
 
 _SAMPLER_DICT = {
     1: "ddim",
@@ -89,23 +118,361 @@ _SAMPLER_DICT = {
     9: "others",
 }
 
+# Lookup array to map sampler codes to names with a single pc.take() call
+_SAMPLER_NAMES = pa.array(
+    [_SAMPLER_DICT.get(i) for i in range(max(_SAMPLER_DICT) + 1)], pa.string()
+)
+
+# The metadata table stores sampler codes, map names back to codes for filters
+_SAMPLER_CODES = {name: code for code, name in _SAMPLER_DICT.items()}
+
+# Memory-map the metadata parquet file so only the pages that are read are loaded
+# into memory. Set DIFFUSIONDB_MEMORY_MAP=0 to disable it (e.g., on file
+# systems that do not support mmap)
+_MEMORY_MAP = os.environ.get("DIFFUSIONDB_MEMORY_MAP", "1") != "0"
+
+# The number of parts that are downloaded and extracted ahead of the part whose
+# table is being generated, when pipeline_parts is set
+_PIPELINE_PREFETCH_PARTS = 4
+
+# Columns of the metadata parquet file that are yielded in the text_only configs
+_METADATA_COLUMNS = [
+    "image_name",
+    "prompt",
+    "part_id",
+    "seed",
+    "step",
+    "cfg",
+    "sampler",
+    "width",
+    "height",
+    "user_name",
+    "timestamp",
+    "image_nsfw",
+    "prompt_nsfw",
+]
+
+# Columns of the part-xxxxxx.json files. Casting to this schema happens once per
+# part in Arrow instead of calling int() and float() on every row
+_PART_JSON_SCHEMA = pa.schema(
+    [
+        ("image_name", pa.string()),
+        ("p", pa.string()),
+        ("se", pa.int64()),
+        ("st", pa.int64()),
+        ("c", pa.float32()),
+        ("sa", pa.string()),
+    ]
+)
+
+
+def _read_part_table(json_path):
+    """
+    Read the prompts and parameters of one image part into an Arrow table.
+    Args:
+        json_path (str): Path to the part-xxxxxx.json file of the image part
+    Returns:
+        pa.Table: One row per image, with columns in _PART_JSON_SCHEMA
+    """
+    if orjson is not None:
+        with open(json_path, "rb") as json_file:
+            json_data = orjson.loads(json_file.read())
+    else:
+        with open(json_path, "r", encoding="utf8") as json_file:
+            json_data = load(json_file)
+
+    rows = [
+        {"image_name": img_name, **img_params}
+        for img_name, img_params in json_data.items()
+    ]
+    return pa.Table.from_pylist(rows, schema=_PART_JSON_SCHEMA)
+
+
+def _extract_part(archive_path, extract_dir):
+    """
+    Extract a downloaded image part zip file.
+    Args:
+        archive_path (str): Path to the downloaded part-xxxxxx.zip file
+        extract_dir (str): Path to the folder to extract the part into
+    """
+    # Extract to a temporary folder first so an interrupted extraction is not
+    # mistaken for a finished one
+    tmp_dir = extract_dir + ".incomplete"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    with zipfile.ZipFile(archive_path) as zip_file:
+        zip_file.extractall(tmp_dir)
+
+    os.rename(tmp_dir, extract_dir)
+
+
+def _pipelined_part_dir(dl_manager, part_url):
+    """
+    Get the folder that a pipelined image part is extracted into. dl_manager
+    names its extracted folders after the downloaded archive, which we remove,
+    so we name the folder after the part URL instead. This lets us find an
+    extracted part before downloading it again. The folder is still in
+    dl_manager's extraction directory.
+    Args:
+        dl_manager (datasets.DownloadManager): The download manager
+        part_url (str): URL of the part-xxxxxx.zip file
+    Returns:
+        str: Path to the folder with the extracted images and json file
+    """
+    cache_dir = (
+        dl_manager.download_config.cache_dir
+        or datasets.config.DOWNLOADED_DATASETS_PATH
+    )
+    return join(
+        str(cache_dir),
+        datasets.config.EXTRACTED_DATASETS_DIR,
+        "diffusiondb-" + sha256(part_url.encode("utf8")).hexdigest(),
+    )
+
+
+def _extract_pipelined_part(archive_path, extract_dir):
+    """
+    Extract one downloaded image part, then remove the zip file to save disk.
+    Args:
+        archive_path (str): Path to the downloaded part-xxxxxx.zip file
+        extract_dir (str): Path to the folder to extract the part into
+    Returns:
+        str: Path to the folder with the extracted images and json file
+    """
+    shutil.rmtree(extract_dir, ignore_errors=True)
+    _extract_part(archive_path, extract_dir)
+    os.remove(archive_path)
+    return extract_dir
+
+
+def _iter_pipelined_parts(dl_manager, part_urls, part_ids):
+    """
+    Download and extract image parts in the background while the caller
+    consumes them in order. At most _PIPELINE_PREFETCH_PARTS parts are waiting
+    to be consumed. Parts that are already extracted are not downloaded again.
+    Args:
+        dl_manager (datasets.DownloadManager): The download manager
+        part_urls ([str]): URLs of the part zip files
+        part_ids ([int]): The part_ids, in the same order as part_urls
+    Yields:
+        (int, str, str): The part_id, extracted folder, and json path of a part
+    """
+    # Futures of the extracted folders (or an exception), in part order
+    ready_parts = queue.Queue(maxsize=_PIPELINE_PREFETCH_PARTS)
+    stopped = threading.Event()
+    force_download = dl_manager.download_config.force_download
+
+    def put(item):
+        # Stop waiting for a free slot once the consumer is gone
+        while not stopped.is_set():
+            try:
+                ready_parts.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    with ThreadPoolExecutor(max_workers=_PIPELINE_PREFETCH_PARTS) as executor:
+
+        def download_parts():
+            # dl_manager is not thread-safe, so this is the only thread that
+            # calls it, one part at a time. Only the unzip runs in the pool.
+            try:
+                for part_url in part_urls:
+                    extract_dir = _pipelined_part_dir(dl_manager, part_url)
+
+                    if exists(extract_dir) and not force_download:
+                        future = Future()
+                        future.set_result(extract_dir)
+                    else:
+                        archive_path = dl_manager.download(part_url)
+                        future = executor.submit(
+                            _extract_pipelined_part, archive_path, extract_dir
+                        )
+
+                    if not put(future):
+                        return
+            except Exception as e:
+                put(e)
+
+        producer = threading.Thread(target=download_parts, daemon=True)
+        producer.start()
+
+        try:
+            for cur_part_id in part_ids:
+                item = ready_parts.get()
+                if isinstance(item, Exception):
+                    raise item
+
+                data_dir = item.result()
+                yield cur_part_id, data_dir, join(
+                    data_dir, f"part-{cur_part_id:06}.json"
+                )
+        finally:
+            stopped.set()
+            producer.join()
+
+
+def _read_image_bytes(img_path):
+    """
+    Read a local image file in one go. We tell the kernel that the file is read
+    sequentially and read its full size with a single os.read() call when
+    possible, instead of going through a buffered file object.
+    Args:
+        img_path (str): Path to the image file
+    Returns:
+        bytes: The content of the image file
+    """
+    fd = os.open(img_path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        # posix_fadvise() is not available on all platforms (e.g., macOS)
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        size = os.fstat(fd).st_size
+        chunks = []
+        while size > 0:
+            chunk = os.read(fd, size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+
+        return chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    finally:
+        os.close(fd)
+
+
+def _iter_metadata_batches(metadata_path, columns, is_streaming):
+    """
+    Read the metadata parquet file in record batches.
+    Args:
+        metadata_path (str): Path (or URL in streaming mode) of the parquet file
+        columns ([str]): The columns to read
+        is_streaming (bool): If the dataset is loaded in streaming mode
+    Yields:
+        pa.RecordBatch: Batches of up to 4096 metadata rows
+    """
+    if is_streaming:
+        # datasets does not patch pq.ParquetFile() for streaming, so we open the
+        # remote file with the patched open() and pass the file object
+        with open(metadata_path, "rb") as metadata_file:
+            yield from pq.ParquetFile(metadata_file).iter_batches(
+                batch_size=4096, columns=columns
+            )
+    else:
+        # Only local files can be memory-mapped
+        metadata_file = pq.ParquetFile(metadata_path, memory_map=_MEMORY_MAP)
+        yield from metadata_file.iter_batches(batch_size=4096, columns=columns)
+
+
+def _encode_sampler_filters(filters):
+    """
+    Replace sampler names in parquet filters with the sampler codes that are
+    stored in the metadata table, so that users can filter by sampler name.
+    Args:
+        filters (list): Filters in the pyarrow.parquet.read_table() format, a
+            list of (column, op, value) tuples or a list of such lists
+    Returns:
+        list: The filters with sampler names replaced by codes, or None if there
+            is no filter
+    """
+    if not filters:
+        return None
+
+    def encode_value(value):
+        if isinstance(value, str):
+            if value not in _SAMPLER_CODES:
+                raise ValueError(f"Unknown sampler {value!r} in filters")
+            return _SAMPLER_CODES[value]
+        if isinstance(value, (list, tuple, set)):
+            return [encode_value(v) for v in value]
+        return value
+
+    def encode_term(term):
+        column, op, value = term
+        if column == "sampler":
+            value = encode_value(value)
+        return (column, op, value)
+
+    # A single conjunction: [(column, op, value), ...]
+    if isinstance(filters[0][0], str):
+        return [encode_term(term) for term in filters]
+
+    # Disjunction of conjunctions: [[(column, op, value), ...], ...]
+    return [[encode_term(term) for term in conjunction] for conjunction in filters]
+
 
 class DiffusionDBConfig(datasets.BuilderConfig):
     """BuilderConfig for DiffusionDB."""
 
-    def __init__(self, part_ids, is_large, **kwargs):
+    def __init__(
+        self,
+        part_ids=None,
+        is_large=False,
+        num_random_parts=None,
+        random_seed=0,
+        eager_image_bytes=False,
+        columns=None,
+        filters=None,
+        pipeline_parts=False,
+        **kwargs,
+    ):
         """BuilderConfig for DiffusionDB.
         Args:
-          part_ids([int]): A list of part_ids.
+          part_ids([int]): A list of part_ids. If None, `num_random_parts`
+            part_ids are randomly sampled when they are first accessed.
           is_large(bool): If downloading data from DiffusionDB Large (14 million)
+          num_random_parts(int): The number of part_ids to randomly sample if
+            `part_ids` is None.
+          random_seed(int): The seed used to sample the random part_ids.
+          eager_image_bytes(bool): If True, read the image bytes while
+            generating examples. By default only the image path is stored and
+            the image is decoded lazily on access.
+          columns([str]): text_only only. The metadata columns to load, all
+            columns are loaded if None.
+          filters([tuple]): text_only only. Row filters in the
+            pyarrow.parquet.read_table() format, e.g.,
+            [("sampler", "in", ["k_lms", "ddim"])]. Row groups that cannot match
+            are skipped without being read.
+          pipeline_parts(bool): If True, download and extract image parts while
+            the dataset is being generated instead of all parts up front. The
+            zip files are removed after extraction, and with
+            `eager_image_bytes` the extracted folders are also removed once
+            their images are written, so only a few parts are kept on disk.
           **kwargs: keyword arguments forwarded to super.
         """
         super(DiffusionDBConfig, self).__init__(version=_VERSION, **kwargs)
-        self.part_ids = part_ids
+        self._part_ids = part_ids
         self.is_large = is_large
+        self.num_random_parts = num_random_parts
+        self.random_seed = random_seed
+        self.eager_image_bytes = eager_image_bytes
+        self.columns = columns
+        self.filters = filters
+        self.pipeline_parts = pipeline_parts
+
+    @property
+    def part_ids(self):
+        """The part_ids of this config. Random part_ids are only sampled (with
+        a fixed seed) for the config that is actually loaded."""
+        if self._part_ids is None:
+            total_part_ids = _PART_IDS_LARGE if self.is_large else _PART_IDS
+            # Sample indices instead of passing the range, so numpy does not
+            # need to materialize all part_ids as an array
+            rng = np.random.default_rng(self.random_seed)
+            self._part_ids = (
+                rng.choice(len(total_part_ids), self.num_random_parts, replace=False)
+                + total_part_ids[0]
+            )
+        return self._part_ids
+
+    @part_ids.setter
+    def part_ids(self, part_ids):
+        self._part_ids = part_ids
 
 
-class DiffusionDB(datasets.GeneratorBasedBuilder):
+class DiffusionDB(datasets.ArrowBasedBuilder):
     """A large-scale text-to-image prompt gallery dataset based on Stable Diffusion."""
 
     BUILDER_CONFIGS = []
@@ -127,11 +494,8 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                         f"Random {num_k_str} images with their prompts and parameters"
                     )
 
-                    # Sample part_ids
-                    total_part_ids = _PART_IDS_LARGE if is_large else _PART_IDS
-                    part_ids = np.random.choice(
-                        total_part_ids, num_k, replace=False
-                    ).tolist()
+                    # Random part_ids are sampled lazily by the config
+                    part_ids = None
                 else:
                     # Name the config
                     cur_name = subset_str + "first_" + num_k_str
@@ -139,9 +503,8 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                     # Add a short description for each config
                     cur_description = f"The first {num_k_str} images in this dataset with their prompts and parameters"
 
-                    # Sample part_ids
-                    total_part_ids = _PART_IDS_LARGE if is_large else _PART_IDS
-                    part_ids = total_part_ids[1 : num_k + 1]
+                    # The first part_ids are a contiguous range
+                    part_ids = range(1, num_k + 1)
 
                 # Create configs
                 BUILDER_CONFIGS.append(
@@ -149,6 +512,7 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                         name=cur_name,
                         part_ids=part_ids,
                         is_large=is_large,
+                        num_random_parts=num_k,
                         description=cur_description,
                     ),
                 )
@@ -168,11 +532,8 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                     f"Random {num_k_str} images with their prompts and parameters"
                 )
 
-                # Sample part_ids
-                total_part_ids = _PART_IDS_LARGE
-                part_ids = np.random.choice(
-                    total_part_ids, num_k, replace=False
-                ).tolist()
+                # Random part_ids are sampled lazily by the config
+                part_ids = None
             else:
                 # Name the config
                 cur_name = subset_str + "first_" + num_k_str
@@ -180,9 +541,8 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                 # Add a short description for each config
                 cur_description = f"The first {num_k_str} images in this dataset with their prompts and parameters"
 
-                # Sample part_ids
-                total_part_ids = _PART_IDS_LARGE
-                part_ids = total_part_ids[1 : num_k + 1]
+                # The first part_ids are a contiguous range
+                part_ids = range(1, num_k + 1)
 
             # Create configs
             BUILDER_CONFIGS.append(
@@ -190,6 +550,7 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                     name=cur_name,
                     part_ids=part_ids,
                     is_large=True,
+                    num_random_parts=num_k,
                     description=cur_description,
                 ),
             )
@@ -233,13 +594,13 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
     )
 
     # Add a random 1k from 2M as the first entry point to show on HF data viewer
-    # Sample part_ids
-    part_ids = np.random.choice(_PART_IDS, 1000, replace=False).tolist()
+    # Use a different seed so it is not the same sample as 2m_random_1k
     BUILDER_CONFIGS.append(
         DiffusionDBConfig(
             name="1k_random_2m",
-            part_ids=part_ids,
             is_large=False,
+            num_random_parts=1000,
+            random_seed=1,
             description="Another random 1k images with meta data from DiffusionDB 2M",
         ),
     )
@@ -269,7 +630,28 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
                 },
             )
 
+            # Only keep the features of the selected columns
+            if self.config.columns is not None:
+                if not self.config.columns:
+                    raise ValueError("columns must include at least one column")
+
+                unknown_columns = set(self.config.columns) - set(features)
+                if unknown_columns:
+                    raise ValueError(
+                        f"Unknown metadata columns: {sorted(unknown_columns)}"
+                    )
+
+                features = datasets.Features(
+                    {column: features[column] for column in self.config.columns}
+                )
+
         else:
+            # Column projection and row filters only apply to the metadata table
+            if self.config.columns is not None or self.config.filters is not None:
+                raise ValueError(
+                    "columns and filters are only supported by the text_only configs"
+                )
+
             features = datasets.Features(
                 {
                     "image": datasets.Image(),
@@ -308,113 +690,219 @@ class DiffusionDB(datasets.GeneratorBasedBuilder):
         # archive
 
         # Download and extract zip files of all sampled part_ids
-        data_dirs = []
-        json_paths = []
+        part_ids = list(self.config.part_ids)
+        part_urls = [
+            _part_url(cur_part_id, self.config.is_large) for cur_part_id in part_ids
+        ]
+        metadata_url = _metadata_url(self.config.is_large)
 
-        # Resolve the urls
-        if self.config.is_large:
-            urls = _URLS_LARGE
+        if self.config.pipeline_parts and not dl_manager.is_streaming:
+            # Parts are downloaded while tables are generated, so we only
+            # download the metadata table here
+            data_dirs = None
+            metadata_path = dl_manager.download(metadata_url)
         else:
-            urls = _URLS
-
-        for cur_part_id in self.config.part_ids:
-            cur_url = urls[cur_part_id]
-            data_dir = dl_manager.download_and_extract(cur_url)
-
-            data_dirs.append(data_dir)
-            json_paths.append(join(data_dir, f"part-{cur_part_id:06}.json"))
+            # Download and extract all parts and the metadata table in a single
+            # dl_manager call. It processes the urls in parallel over
+            # download_config.num_proc, which load_dataset(..., num_proc=N)
+            # sets, and the parquet file is returned as is since it is not an
+            # archive. The returned paths keep the same order as part_urls.
+            # The metadata url is also wrapped in a list, as dl_manager splits
+            # a plain string into characters when it is next to a list.
+            downloaded_paths = dl_manager.download_and_extract(
+                {"parts": part_urls, "metadata": [metadata_url]}
+            )
+            data_dirs = downloaded_paths["parts"]
+            metadata_path = downloaded_paths["metadata"][0]
 
-        # Also download the metadata table
-        metadata_path = dl_manager.download(urls["metadata"])
+        if data_dirs is None:
+            json_paths = None
+        else:
+            json_paths = [
+                join(data_dir, f"part-{cur_part_id:06}.json")
+                for data_dir, cur_part_id in zip(data_dirs, part_ids)
+            ]
 
         return [
             datasets.SplitGenerator(
                 name=datasets.Split.TRAIN,
-                # These kwargs will be passed to _generate_examples
+                # These kwargs will be passed to _generate_tables
                 gen_kwargs={
+                    "part_ids": part_ids,
                     "data_dirs": data_dirs,
                     "json_paths": json_paths,
                     "metadata_path": metadata_path,
+                    "is_streaming": dl_manager.is_streaming,
+                    "part_urls": part_urls if data_dirs is None else None,
+                    "dl_manager": dl_manager if data_dirs is None else None,
                 },
             ),
         ]
 
-    def _generate_examples(self, data_dirs, json_paths, metadata_path):
+    def _generate_tables(
+        self,
+        part_ids,
+        data_dirs,
+        json_paths,
+        metadata_path,
+        is_streaming,
+        part_urls,
+        dl_manager,
+    ):
         # This method handles input defined in _split_generators to yield
-        # (key, example) tuples from the dataset.
+        # (key, table) tuples from the dataset. Yielding Arrow tables lets
+        # datasets write whole batches instead of encoding one example at a time.
         # The `key` is for legacy reasons (tfds) and is not important in itself,
-        # but must be unique for each example.
+        # but must be unique for each table.
 
-        # Load the metadata parquet file if the config is text_only
+        # The config is fixed for a builder, so we only branch once here and each
+        # generator below only contains the code for its own configs
         if "text_only" in self.config.name:
-            metadata_df = pd.read_parquet(metadata_path)
-            for _, row in metadata_df.iterrows():
-                yield row["image_name"], {
-                    "image_name": row["image_name"],
-                    "prompt": row["prompt"],
-                    "part_id": row["part_id"],
-                    "seed": row["seed"],
-                    "step": row["step"],
-                    "cfg": row["cfg"],
-                    "sampler": _SAMPLER_DICT[int(row["sampler"])],
-                    "width": row["width"],
-                    "height": row["height"],
-                    "user_name": row["user_name"],
-                    "timestamp": None
-                    if pd.isnull(row["timestamp"])
-                    else row["timestamp"],
-                    "image_nsfw": row["image_nsfw"],
-                    "prompt_nsfw": row["prompt_nsfw"],
-                }
+            return self._generate_text_only_tables(metadata_path, is_streaming)
+
+        return self._generate_image_tables(
+            part_ids,
+            data_dirs,
+            json_paths,
+            metadata_path,
+            is_streaming,
+            part_urls,
+            dl_manager,
+        )
+
+    def _generate_text_only_tables(self, metadata_path, is_streaming):
+        """Yield one Arrow table per record batch of the metadata parquet file
+        for text_only configs."""
+        # Stream the parquet file in record batches instead of loading the
+        # whole table into a DataFrame
+        if self.config.columns is None:
+            columns = _METADATA_COLUMNS
+        else:
+            columns = self.config.columns
+        filters = _encode_sampler_filters(self.config.filters)
 
+        if filters is None:
+            batches = _iter_metadata_batches(metadata_path, columns, is_streaming)
         else:
-            num_data_dirs = len(data_dirs)
-            assert num_data_dirs == len(json_paths)
-
-            # Read the metadata table (only rows with the needed part_ids)
-            part_ids = []
-            for path in json_paths:
-                cur_id = int(re.sub(r"part-(\d+)\.json", r"\1", basename(path)))
-                part_ids.append(cur_id)
-
-            # We have to use pandas here to make the dataset preview work (it
-            # uses streaming mode)
-            metadata_table = pd.read_parquet(
+            # Row groups whose statistics do not match the filters are
+            # skipped, and only the matching rows are kept in memory
+            metadata_table = pq.read_table(
                 metadata_path,
-                filters=[("part_id", "in", part_ids)],
+                columns=columns,
+                filters=filters,
+                memory_map=_MEMORY_MAP and not is_streaming,
+            )
+            batches = metadata_table.to_batches(max_chunksize=4096)
+
+        for key, batch in enumerate(batches):
+            # Map the sampler codes to names for the whole batch at once
+            sampler_index = batch.schema.get_field_index("sampler")
+            if sampler_index != -1:
+                batch_columns = batch.columns
+                batch_columns[sampler_index] = pc.take(
+                    _SAMPLER_NAMES, batch_columns[sampler_index].cast(pa.int32())
+                )
+                batch = pa.RecordBatch.from_arrays(
+                    batch_columns, names=batch.schema.names
+                )
+
+            yield key, pa.Table.from_batches([batch])
+
+    def _generate_image_tables(
+        self,
+        part_ids,
+        data_dirs,
+        json_paths,
+        metadata_path,
+        is_streaming,
+        part_urls,
+        dl_manager,
+    ):
+        """Yield one table of images, prompts, and metadata per image part."""
+        if data_dirs is None:
+            # Download and extract the parts while we generate the tables
+            parts = _iter_pipelined_parts(dl_manager, part_urls, part_ids)
+        else:
+            assert len(data_dirs) == len(json_paths) == len(part_ids)
+            parts = zip(part_ids, data_dirs, json_paths)
+
+        # Read the metadata table (only rows with the needed part_ids). Sort it
+        # by part_id, so the rows of each part are a contiguous slice that we
+        # can find with a binary search
+        metadata_table = pq.read_table(
+            metadata_path,
+            columns=[
+                "image_name",
+                "part_id",
+                "width",
+                "height",
+                "user_name",
+                "timestamp",
+                "image_nsfw",
+                "prompt_nsfw",
+            ],
+            filters=[("part_id", "in", [int(i) for i in part_ids])],
+            memory_map=_MEMORY_MAP and not is_streaming,
+        ).sort_by("part_id")
+        metadata_part_ids = metadata_table.column("part_id").to_numpy()
+
+        eager_image_bytes = self.config.eager_image_bytes
+
+        # Iterate through all extracted zip folders for images
+        for cur_part_id, cur_data_dir, cur_json_path in parts:
+            part_table = _read_part_table(cur_json_path)
+            img_names = part_table.column("image_name")
+
+            # Align the metadata rows of this part with the json rows
+            start = np.searchsorted(metadata_part_ids, cur_part_id, "left")
+            end = np.searchsorted(metadata_part_ids, cur_part_id, "right")
+            part_metadata = metadata_table.slice(start, end - start)
+            part_metadata = part_metadata.take(
+                pc.index_in(img_names, value_set=part_metadata["image_name"])
+            )
+
+            # We keep using join() rather than concatenating strings,
+            # because it also resolves paths inside archives in streaming
+            # mode
+            img_paths = [
+                join(cur_data_dir, img_name) for img_name in img_names.to_pylist()
+            ]
+
+            # Only store the image path by default, datasets.Image() reads
+            # and decodes the file when the example is accessed
+            img_bytes = [None] * len(img_paths)
+            if eager_image_bytes and is_streaming:
+                # Images are inside remote archives, open() is patched to
+                # read them in streaming mode
+                for i, img_path in enumerate(img_paths):
+                    with open(img_path, "rb") as img_file:
+                        img_bytes[i] = img_file.read()
+            elif eager_image_bytes:
+                img_bytes = [_read_image_bytes(img_path) for img_path in img_paths]
+
+            images = pa.StructArray.from_arrays(
+                [pa.array(img_bytes, pa.binary()), pa.array(img_paths, pa.string())],
+                names=["bytes", "path"],
+            )
+
+            yield cur_part_id, pa.table(
+                {
+                    "image": images,
+                    "prompt": part_table.column("p"),
+                    "seed": part_table.column("se"),
+                    "step": part_table.column("st"),
+                    "cfg": part_table.column("c"),
+                    "sampler": part_table.column("sa"),
+                    "width": part_metadata.column("width"),
+                    "height": part_metadata.column("height"),
+                    "user_name": part_metadata.column("user_name"),
+                    "timestamp": part_metadata.column("timestamp"),
+                    "image_nsfw": part_metadata.column("image_nsfw"),
+                    "prompt_nsfw": part_metadata.column("prompt_nsfw"),
+                }
             )
 
-            # Iterate through all extracted zip folders for images
-            for k in range(num_data_dirs):
-                cur_data_dir = data_dirs[k]
-                cur_json_path = json_paths[k]
-
-                json_data = load(open(cur_json_path, "r", encoding="utf8"))
-
-                for img_name in json_data:
-                    img_params = json_data[img_name]
-                    img_path = join(cur_data_dir, img_name)
-
-                    # Query the metadata
-                    query_result = metadata_table.query(f'`image_name` == "{img_name}"')
-
-                    # Yields examples as (key, example) tuples
-                    yield img_name, {
-                        "image": {
-                            "path": img_path,
-                            "bytes": open(img_path, "rb").read(),
-                        },
-                        "prompt": img_params["p"],
-                        "seed": int(img_params["se"]),
-                        "step": int(img_params["st"]),
-                        "cfg": float(img_params["c"]),
-                        "sampler": img_params["sa"],
-                        "width": query_result["width"].to_list()[0],
-                        "height": query_result["height"].to_list()[0],
-                        "user_name": query_result["user_name"].to_list()[0],
-                        "timestamp": None
-                        if pd.isnull(query_result["timestamp"].to_list()[0])
-                        else query_result["timestamp"].to_list()[0],
-                        "image_nsfw": query_result["image_nsfw"].to_list()[0],
-                        "prompt_nsfw": query_result["prompt_nsfw"].to_list()[0],
-                    }
+            # The image bytes are already written, so a pipelined part is no
+            # longer needed on disk
+            if data_dirs is None and eager_image_bytes:
+                shutil.rmtree(cur_data_dir)
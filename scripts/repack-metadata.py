@@ -0,0 +1,92 @@
+"""Repack the metadata parquet file with narrower column types and ZSTD."""
+
+from os.path import getsize
+
+import time
+import argparse
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Narrowest types that fit the values of each column. The casts are checked, so
+# the script fails instead of silently overflowing if a value does not fit.
+COLUMN_TYPES = {
+    "image_name": pa.string(),
+    "prompt": pa.string(),
+    "part_id": pa.uint16(),
+    "seed": pa.uint32(),
+    "step": pa.uint16(),
+    "cfg": pa.float32(),
+    "sampler": pa.uint8(),
+    "width": pa.uint16(),
+    "height": pa.uint16(),
+    "user_name": pa.string(),
+    "timestamp": pa.timestamp("us", tz="UTC"),
+    "image_nsfw": pa.float32(),
+    "prompt_nsfw": pa.float32(),
+}
+
+# Columns with many repeated values benefit from dictionary encoding
+DICTIONARY_COLUMNS = ["prompt", "part_id", "sampler", "user_name"]
+
+
+def repack(src_path, dst_path, compression_level=3):
+    """
+    Rewrite a metadata parquet file with narrowed types and ZSTD compression.
+    Args:
+        src_path (str): Path to the original metadata parquet file
+        dst_path (str): Path to write the repacked parquet file
+        compression_level (int): ZSTD compression level
+    """
+    table = pq.read_table(src_path)
+
+    # Validate the columns before casting
+    missing_columns = set(COLUMN_TYPES) - set(table.column_names)
+    if missing_columns:
+        raise ValueError(f"Missing metadata columns: {sorted(missing_columns)}")
+
+    schema = pa.schema(
+        [
+            pa.field(name, COLUMN_TYPES.get(name, table.schema.field(name).type))
+            for name in table.column_names
+        ]
+    )
+    table = table.cast(schema, safe=True)
+
+    pq.write_table(
+        table,
+        dst_path,
+        compression="zstd",
+        compression_level=compression_level,
+        use_dictionary=DICTIONARY_COLUMNS,
+        data_page_size=1 << 20,
+    )
+
+
+def main():
+    """
+    Main function
+    """
+    parser = argparse.ArgumentParser(description="Repack the metadata parquet file")
+    parser.add_argument("src", type=str, help="Path to the original parquet file")
+    parser.add_argument("dst", type=str, help="Path to the repacked parquet file")
+    parser.add_argument(
+        "-l",
+        "--level",
+        type=int,
+        default=3,
+        help="ZSTD compression level",
+    )
+    args = parser.parse_args()
+
+    start_time = time.time()
+    repack(args.src, args.dst, args.level)
+
+    print(
+        f"Repacked {getsize(args.src) / 1e6:.1f} MB to {getsize(args.dst) / 1e6:.1f} MB"
+    )
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()